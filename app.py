@@ -1,9 +1,15 @@
 # app.py
 import streamlit as st
-from openai import OpenAI
-import tempfile
+from openai import OpenAI, DefaultHttpxClient, RateLimitError, APIConnectionError, APIStatusError
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import hashlib
+import io
+import re
+import threading
+import time
 import warnings
-import os
 
 warnings.filterwarnings("ignore")
 
@@ -29,54 +35,240 @@ Answer questions about your plays, sonnets, and characters using wit, sharp humo
 and deep literary insight. Focus strictly on Shakespearean literature.
 """
 
+# Shakespeare voice styles -> gpt-4o-mini-tts voices (alloy, ash, ballad, coral,
+# echo, fable, nova, onyx, sage, shimmer, verse)
+VOICE_MAP = {
+    "Dramatic Stage Voice": "alloy",
+    "Warm, Noble Bard": "verse",
+    "Aged Shakespeare": "sage",
+    "Playful Jester": "fable",
+    "Royal Court Voice": "onyx",
+    "Whispered Bard": "shimmer"
+}
+
+# end of a sentence: terminal punctuation, an optional closing quote/bracket, then
+# whitespace. Punctuation right after a digit is skipped, so numbered-list markers
+# ("1. Hamlet") and numbers ("3.5") are not split off on their own.
+SENT_RE = re.compile(r'(?<!\d)[.!?]["\')\]]?\s+')
+
+# TTS time grows with input length, so text that runs this long without a
+# sentence end is cut at a line break or comma (about 150 tokens)
+SPEECH_CHUNK_CHARS = 600
+
+# chat replies and TTS clips shared across sessions: expiry in seconds and entry cap
+CACHE_TTL = 3600
+CACHE_SIZE = 256
+
+# spoken replies kept per session, keyed on (sha256 of the reply, voice)
+TTS_SESSION_CACHE_SIZE = 32
+
+# only the system prompt plus this many recent messages (8 exchanges) are
+# sent with each request; the full history is still kept for display
+MAX_HISTORY_MESSAGES = 16
+
+def is_transient_error(e):
+    """
+    Whether `e` is worth retrying, by the SDK's own rules: dropped connections
+    and timeouts, 408, 409, 429 and 5xx. An exhausted quota is also a 429 but
+    never clears, so it is surfaced straight away.
+    """
+    if isinstance(e, APIConnectionError):  # includes APITimeoutError
+        return True
+    if isinstance(e, RateLimitError):
+        return e.code != "insufficient_quota"
+    return isinstance(e, APIStatusError) and (e.status_code in (408, 409) or e.status_code >= 500)
+
+# transient OpenAI failures are retried with jittered exponential backoff
+# before anything is shown to the user
+openai_retry = retry(
+    wait=wait_random_exponential(min=1, max=20),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception(is_transient_error),
+    reraise=True
+)
+
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
-def safe_get_assistant_text(response):
+def safe_get_transcription_text(transcription):
+    # SDK responses are pydantic models; fall back to a plain dict without
+    # probing via exceptions
+    if isinstance(transcription, dict):
+        return transcription.get("text")
+    return getattr(transcription, "text", None)
+
+@openai_retry
+def transcribe_audio(client, voice_file, on_delta=None):
     """
-    Attempt a few ways to extract text from a chat completion response object.
-    Works across slightly different return shapes.
+    Transcribe one uploaded recording, streaming the text as it is decoded.
+    `on_delta` receives each new piece of text as it arrives; leave it unset
+    on worker threads, which must not touch Streamlit elements. UploadedFile is
+    already in memory, so the SDK gets a (filename, bytes, mimetype) tuple.
     """
-    try:
-        # preferred: object attribute
-        return response.choices[0].message.content
-    except Exception:
-        try:
-            # fallback: mapping-like
-            return response.choices[0].message["content"]
-        except Exception:
-            try:
-                return response.choices[0]["message"]["content"]
-            except Exception:
-                # last resort: string representation
-                return str(response)
+    stream = client.audio.transcriptions.create(
+        model="gpt-4o-mini-transcribe",
+        file=(voice_file.name, voice_file.getvalue(), voice_file.type),
+        stream=True
+    )
+    parts = []
+    text = None
+    for event in stream:
+        if event.type == "transcript.text.delta":
+            parts.append(event.delta)
+            if on_delta:
+                on_delta(event.delta)
+        elif event.type == "transcript.text.done":
+            text = safe_get_transcription_text(event)
+    return text or "".join(parts)
 
-def safe_get_transcription_text(transcription):
-    try:
-        return getattr(transcription, "text", None) or transcription.get("text")  # handles attr or dict
-    except Exception:
-        return None
-
-def safe_get_audio_bytes(audio_response):
-    """
-    audio_response may be a streaming / file-like object or wrapper.
-    Attempt common access patterns.
-    """
-    try:
-        if hasattr(audio_response, "read"):
-            return audio_response.read()
-        if hasattr(audio_response, "content"):
-            return audio_response.content
-        if isinstance(audio_response, (bytes, bytearray)):
-            return bytes(audio_response)
-        # if it's a dict-like with 'data' or 'audio' keys
-        if isinstance(audio_response, dict):
-            for k in ("audio", "data", "content"):
-                if k in audio_response:
-                    return audio_response[k]
-    except Exception:
-        pass
-    return None
+def hash_api_key(api_key):
+    # cache keys carry a digest of the key, never the key itself
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=32, show_spinner=False)
+def get_client(api_key_hash):
+    """
+    One OpenAI client per API key, kept across reruns so chat, speech and
+    transcription calls reuse the same pooled HTTP/2 keep-alive connections.
+    The key itself is read from session state; only its digest is the cache key.
+    Bounded, so a shared deployment does not keep a client (and key) alive for
+    every key ever entered.
+    """
+    return OpenAI(
+        api_key=st.session_state.api_key,
+        max_retries=0,  # retries are handled by openai_retry
+        # keep the SDK's default timeouts and pool limits, only switch on HTTP/2
+        http_client=DefaultHttpxClient(http2=True)
+    )
+
+@openai_retry
+def create_chat_stream(client, **kwargs):
+    # only opening the stream is retried; a reply that fails mid-stream is not
+    # replayed, since its sentences may already have been sent to TTS
+    return client.chat.completions.create(stream=True, **kwargs)
+
+def pop_sentences(text, max_chars=SPEECH_CHUNK_CHARS):
+    """
+    Split the finished sentences off the front of `text`.
+    Returns (sentences, remainder) where remainder is the unfinished tail.
+    A tail longer than `max_chars` with no sentence end (a quoted sonnet, say)
+    is cut at its last line break or comma, so no TTS request grows unbounded.
+    """
+    sentences = []
+    match = SENT_RE.search(text)
+    while match:
+        sentence = text[:match.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        text = text[match.end():]
+        match = SENT_RE.search(text)
+    while len(text) > max_chars:
+        cut = max(text.rfind("\n", 0, max_chars), text.rfind(",", 0, max_chars))
+        if cut <= 0:
+            cut = text.rfind(" ", 0, max_chars)
+        if cut <= 0:
+            cut = max_chars - 1
+        piece = text[:cut + 1].strip()
+        if piece:
+            sentences.append(piece)
+        text = text[cut + 1:]
+    return sentences, text
+
+@st.cache_resource(show_spinner=False)
+def reply_cache():
+    """
+    Final reply text shared across sessions: an LRU of
+    (api key digest, messages, model) -> (stored_at, text), plus its lock.
+    Only the text is kept, so a hit costs one render and no API call.
+    """
+    return threading.Lock(), OrderedDict()
+
+def get_cached_reply(key):
+    lock, entries = reply_cache()
+    with lock:
+        hit = entries.get(key)
+        if hit is None:
+            return None
+        if time.monotonic() - hit[0] > CACHE_TTL:
+            del entries[key]
+            return None
+        entries.move_to_end(key)
+        return hit[1]
+
+def put_cached_reply(key, text):
+    lock, entries = reply_cache()
+    with lock:
+        entries[key] = (time.monotonic(), text)
+        entries.move_to_end(key)
+        while len(entries) > CACHE_SIZE:
+            entries.popitem(last=False)
+
+def stream_reply(client, messages, model, placeholder, on_sentence=None):
+    """
+    Stream a chat reply into `placeholder` and return the full text.
+    `messages` is a tuple of (role, content) pairs (the reply cache key);
+    each finished sentence is handed to `on_sentence` as soon as it arrives.
+    """
+    stream = create_chat_stream(
+        client,
+        model=model,
+        messages=[{"role": role, "content": content} for role, content in messages],
+        temperature=0.7,
+        max_tokens=800
+    )
+    buf = []
+    pending = ""
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            buf.append(delta)
+            placeholder.markdown("".join(buf))
+            sentences, pending = pop_sentences(pending + delta)
+            if on_sentence:
+                for sentence in sentences:
+                    on_sentence(sentence)
+    # flush whatever trails the last sentence boundary
+    if on_sentence and pending.strip():
+        on_sentence(pending.strip())
+    return "".join(buf)
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_SIZE, show_spinner=False)
+@openai_retry
+def synthesize_speech(_client, text, voice):
+    """
+    Synthesize one chunk of the reply. Runs on a worker thread, so it must not
+    touch Streamlit elements; returns the raw mp3 bytes. mp3 (unlike Ogg/Opus)
+    can be joined frame-wise, so a reply's clips play back as one file.
+    """
+    buf = io.BytesIO()
+    # stream the body as it is produced rather than waiting for the whole file
+    with _client.audio.speech.with_streaming_response.create(
+        model="gpt-4o-mini-tts",
+        voice=voice,
+        input=text,
+        response_format="mp3"
+    ) as resp:
+        for c in resp.iter_bytes(4096):
+            buf.write(c)
+    return buf.getvalue()
+
+def join_mp3(clips):
+    """
+    Concatenate mp3 clips into one playable file. mp3 frames are self-contained,
+    so this is plain byte concatenation once the ID3v2 tag is dropped from every
+    clip after the first.
+    """
+    parts = []
+    for i, clip in enumerate(clips):
+        if i and clip[:3] == b"ID3" and len(clip) >= 10:
+            # tag size is a 4-byte syncsafe int after the 10-byte header,
+            # plus a 10-byte footer when flag 0x10 is set
+            size = (clip[6] << 21) | (clip[7] << 14) | (clip[8] << 7) | clip[9]
+            clip = clip[10 + size + (10 if clip[5] & 0x10 else 0):]
+        parts.append(clip)
+    return b"".join(parts)
 
 # --- Pages ---
 if options == "Home":
@@ -90,26 +282,21 @@ elif options == "About Me":
 
 elif options == "Ask William":
     st.title("Ask William Shakespeare!")
-    st.write("You can type a question or upload a voice recording (wav/mp3/m4a).")
+    st.write("You can type a question or upload one or more voice recordings (wav/mp3/m4a).")
     
     # Text input
     user_question = st.text_input("Type your question:", key="text_question")
 
     # Voice input (file uploader)
     st.markdown("**Or upload a voice question**")
-    voice_file = st.file_uploader("Upload audio (wav, mp3, m4a)", type=["wav", "mp3", "m4a"], key="voice_uploader")
-
-    voice_style = st.selectbox(
-    "Choose Shakespeare's Voice Style:",
-    [
-        "Dramatic Stage Voice",
-        "Warm, Noble Bard",
-        "Aged Shakespeare",
-        "Playful Jester",
-        "Royal Court Voice",
-        "Whispered Bard"
-    ]
-)
+    voice_files = st.file_uploader(
+        "Upload audio (wav, mp3, m4a)",
+        type=["wav", "mp3", "m4a"],
+        accept_multiple_files=True,
+        key="voice_uploader"
+    )
+
+    voice_style = st.selectbox("Choose Shakespeare's Voice Style:", list(VOICE_MAP))
     if st.session_state.messages:
         st.markdown("### Conversation")
         for msg in st.session_state.messages:
@@ -132,7 +319,9 @@ elif options == "Ask William":
         if not api_key or not api_key.startswith("sk-"):
             st.warning("Enter a valid OpenAI API key in the sidebar.")
         else:
-            client = OpenAI(api_key=api_key)
+            api_key_hash = hash_api_key(api_key)
+            st.session_state.api_key = api_key
+            client = get_client(api_key_hash)
 
             # ensure system prompt present
             if not any(m["role"] == "system" for m in st.session_state.messages):
@@ -140,80 +329,135 @@ elif options == "Ask William":
 
             # determine final question: prefer uploaded voice if present, else typed text
             final_question = (user_question or "").strip()
+            user_msg = None
 
-            if voice_file is not None:
-                # save temporary file
-                with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(voice_file.name)[1]) as tmp:
-                    tmp.write(voice_file.read())
-                    tmp_path = tmp.name
-
+            if voice_files:
                 st.info("Transcribing audio…")
-                try:
-                    transcription = client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=open(tmp_path, "rb")
-                    )
-                    trans_text = safe_get_transcription_text(transcription)
-                    if trans_text:
-                        final_question = trans_text
-                        st.markdown(f"**Transcribed:** {final_question}")
-                    else:
-                        st.warning("Could not extract transcription text; using typed input if available.")
-                except Exception as e:
-                    st.error(f"Transcription failed: {e}")
-                finally:
+                slots = [st.empty() for _ in voice_files]
+                if len(voice_files) == 1:
+                    # a lone recording is transcribed on this thread and streamed
+                    # straight into the user message it will become; that message
+                    # joins the history only once the question is final, so an
+                    # interrupted run leaves no half-written turn behind
+                    user_msg = {"role": "user", "content": ""}
+
+                    def on_delta(delta):
+                        user_msg["content"] += delta
+                        slots[0].markdown(f"**Transcribed:** {user_msg['content']}")
+
                     try:
-                        os.remove(tmp_path)
-                    except Exception:
-                        pass
+                        outcomes = [transcribe_audio(client, voice_files[0], on_delta=on_delta)]
+                    except Exception as e:
+                        outcomes = [e]
+                else:
+                    with ThreadPoolExecutor(max_workers=min(8, len(voice_files))) as executor:
+                        futures = [executor.submit(transcribe_audio, client, f) for f in voice_files]
+                    outcomes = [future.exception() or future.result() for future in futures]
+
+                transcripts = []
+                for voice_file, slot, outcome in zip(voice_files, slots, outcomes):
+                    if isinstance(outcome, Exception):
+                        slot.error(f"Transcription of {voice_file.name} failed: {outcome}")
+                    elif outcome:
+                        transcripts.append(outcome)
+                        slot.markdown(f"**Transcribed:** {outcome}")
+                    else:
+                        slot.warning(f"Could not extract transcription text from {voice_file.name}.")
+
+                # several recordings are asked together in a single chat request
+                if len(transcripts) == 1:
+                    final_question = transcripts[0]
+                elif transcripts:
+                    final_question = "\n".join(f"{i}. {t}" for i, t in enumerate(transcripts, 1))
+                else:
+                    st.warning("No transcription text; using typed input if available.")
 
             if not final_question:
                 st.warning("Provide a typed question or upload a voice file.")
                 st.stop()
 
-            # append user message to conversation
-            st.session_state.messages.append({"role": "user", "content": final_question})
+            # append user message to conversation; a streamed one is reused with
+            # its final text (the typed fallback, or the done-event transcript if
+            # a retried stream repeated any deltas)
+            if user_msg is None:
+                user_msg = {"role": "user"}
+            user_msg["content"] = final_question
+            st.session_state.messages.append(user_msg)
 
-            # call chat completion
-            try:
-                with st.spinner("The Bard is composing his reply..."):
-                    response = client.chat.completions.create(
-                        model="gpt-4o-mini",
-                        messages=st.session_state.messages,
-                        temperature=0.7,
-                        max_tokens=800
-                    )
-
-                assistant_reply = safe_get_assistant_text(response)
-                # append assistant reply
-                st.session_state.messages.append({"role": "assistant", "content": assistant_reply})
+            chosen_voice = VOICE_MAP[voice_style]
+
+            # bound the request to the system prompt + a sliding window of recent turns
+            sent = [st.session_state.messages[0]] + st.session_state.messages[1:][-MAX_HISTORY_MESSAGES:]
 
+            # call chat completion, streaming tokens into the page as they arrive
+            # and handing each finished sentence to TTS while the rest is generated
+            try:
                 st.success("Here’s what The Bard says:")
-                st.write(assistant_reply)                
-                # --- Text-to-speech (TTS) ---
-                voice_map = {"Dramatic Stage Voice": "alloy",
-                                "Warm, Noble Bard": "verse",
-                                "Aged Shakespeare": "sage",
-                                "Playful Jester": "spark",
-                                "Royal Court Voice": "duet",
-                                "Whispered Bard": "whisper"
-                            },
-                chosen_voice = voice_map[voice_style]
-
-                try:
-                    with st.spinner("Generating spoken reply..."):
-                        audio_response = client.audio.speech.create(
-                            model="gpt-4o-mini-tts",
-                            voice=chosen_voice,
-                            input=assistant_reply
-                        )
-                    audio_bytes = safe_get_audio_bytes(audio_response)
-                    if audio_bytes:
-                        st.audio(audio_bytes, format="audio/mp3")
+                audio_futures = []
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    def queue_speech(sentence):
+                        # each sentence goes out as soon as it is complete, so only
+                        # the last one is left to synthesize when the text ends
+                        audio_futures.append(executor.submit(synthesize_speech, client, sentence, chosen_voice))
+
+                    reply_key = (api_key_hash, tuple((m["role"], m["content"]) for m in sent), "gpt-4o-mini")
+                    assistant_reply = get_cached_reply(reply_key)
+                    cached = assistant_reply is not None
+                    if cached:
+                        # a cached reply is drawn once, with no API call
+                        st.markdown(assistant_reply)
                     else:
-                        st.warning("Audio generation returned no bytes; reply shown as text only.")
-                except Exception as e:
-                    st.warning(f"TTS generation failed: {e}")
+                        try:
+                            assistant_reply = stream_reply(
+                                client,
+                                reply_key[1],
+                                reply_key[2],
+                                st.empty(),
+                                on_sentence=queue_speech
+                            )
+                        except BaseException:
+                            # the clips queued so far will never play; drop them
+                            # rather than wait for (and pay for) each one on exit
+                            executor.shutdown(wait=False, cancel_futures=True)
+                            raise
+                        # an empty reply is not worth replaying as a hit
+                        if assistant_reply:
+                            put_cached_reply(reply_key, assistant_reply)
+
+                    # reuse this session's clips for a cached reply if there are
+                    # any, and only queue its sentences otherwise
+                    tts_cache = st.session_state.setdefault("_tts_cache", OrderedDict())
+                    tts_key = (hashlib.sha256(assistant_reply.encode()).digest(), chosen_voice)
+                    audio_bytes = tts_cache.get(tts_key) if cached else None
+                    if audio_bytes is not None:
+                        tts_cache.move_to_end(tts_key)
+                    if cached and audio_bytes is None:
+                        sentences, rest = pop_sentences(assistant_reply)
+                        for sentence in sentences + [rest.strip()]:
+                            if sentence:
+                                queue_speech(sentence)
+
+                    # append assistant reply
+                    st.session_state.messages.append({"role": "assistant", "content": assistant_reply})
+
+                    # join the synthesized sentences into a single clip, in order
+                    try:
+                        with st.spinner("Generating spoken reply..."):
+                            if audio_bytes is None:
+                                clips = [future.result() for future in audio_futures]
+                                if clips and all(clips):
+                                    audio_bytes = join_mp3(clips)
+                                    # remember complete replies only, least recently used first out
+                                    tts_cache[tts_key] = audio_bytes
+                                    tts_cache.move_to_end(tts_key)
+                                    while len(tts_cache) > TTS_SESSION_CACHE_SIZE:
+                                        tts_cache.popitem(last=False)
+                        if audio_bytes:
+                            st.audio(audio_bytes, format="audio/mp3")
+                        else:
+                            st.warning("Audio generation returned no bytes; reply shown as text only.")
+                    except Exception as e:
+                        st.warning(f"TTS generation failed: {e}")
 
             except Exception as e:
                 st.error(f"OpenAI request failed: {e}")